@@ -0,0 +1,116 @@
+import argparse
+import math
+import socket
+import struct
+import time
+from threading import Thread
+
+# UDP ping client for PythonUdpPingServer.py. Sends sequence numbered, timestamped packets at a fixed rate
+# and reports round trip time percentiles, loss, reordering and duplicates once all replies arrived
+# or timed out.
+
+HEADER = struct.Struct('>IQ')  # sequence number, send time in nanoseconds
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+parser = argparse.ArgumentParser(description="UDP ping with latency percentiles, loss and reordering")
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=9009)
+parser.add_argument('--rate', type=float, default=100, help="packets sent per second")
+parser.add_argument('--count', type=int, default=1000, help="amount of packets to send")
+parser.add_argument('--size', type=int, default=64, help="datagram size in bytes")
+parser.add_argument('--timeout', type=float, default=1, help="seconds to wait for late replies after the last send")
+args = parser.parse_args()
+
+size = max(args.size, HEADER.size)
+
+client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+client.connect((args.host, args.port))
+client.settimeout(args.timeout)
+
+rtts = [None] * args.count
+reordered = 0
+duplicates = 0
+sending_finished = False
+
+
+def receive():
+    global reordered, duplicates
+
+    buff = bytearray(size)
+    highest_sequence = -1
+    while True:
+        try:
+            received = client.recv_into(buff)
+        except socket.timeout:
+            if sending_finished:
+                return
+            continue
+        except ConnectionRefusedError:
+            # ICMP port unreachable, the server is not running yet
+            continue
+
+        received_at = time.perf_counter_ns()
+        if received < HEADER.size:
+            continue
+
+        sequence, sent_at = HEADER.unpack_from(buff)
+        if sequence >= args.count:
+            continue
+
+        if rtts[sequence] is not None:
+            duplicates += 1
+            continue
+        rtts[sequence] = received_at - sent_at
+
+        if sequence < highest_sequence:
+            reordered += 1
+        else:
+            highest_sequence = sequence
+
+
+print('PYTHON UDP PING CLIENT')
+print(f"pinging {args.host}:{args.port} with {args.count} packets of {size} bytes at {args.rate} packets/s")
+
+receiver = Thread(target=receive, args=(), daemon=True)
+receiver.start()
+
+packet = bytearray(size)
+interval_ns = int(1e9 / args.rate)
+started_at = time.perf_counter_ns()
+for sequence in range(args.count):
+    # packets are scheduled from the start time, so a late send does not shift the following ones
+    delay = started_at + sequence * interval_ns - time.perf_counter_ns()
+    if delay > 0:
+        time.sleep(delay / 1e9)
+
+    HEADER.pack_into(packet, 0, sequence, time.perf_counter_ns())
+    try:
+        client.send(packet)
+    except ConnectionRefusedError:
+        pass
+sending_duration = (time.perf_counter_ns() - started_at) / 1e9
+
+sending_finished = True
+receiver.join()
+client.close()
+
+received_rtts = sorted(rtt / 1e6 for rtt in rtts if rtt is not None)
+lost = args.count - len(received_rtts)
+
+print(f"sent {args.count} packets in {sending_duration:.2f} s ({args.count / sending_duration if sending_duration else 0:.1f} packets/s)")
+print(f"received {len(received_rtts)}, lost {lost} ({100 * lost / args.count:.2f}%), "
+      f"reordered {reordered}, duplicates {duplicates}")
+if received_rtts:
+    print(f"rtt ms: min {received_rtts[0]:.3f}, avg {sum(received_rtts) / len(received_rtts):.3f}, "
+          f"p50 {percentile(received_rtts, 50):.3f}, p90 {percentile(received_rtts, 90):.3f}, "
+          f"p99 {percentile(received_rtts, 99):.3f}, p99.9 {percentile(received_rtts, 99.9):.3f}, "
+          f"max {received_rtts[-1]:.3f}")
@@ -0,0 +1,54 @@
+import argparse
+import socket
+import time
+
+# UDP echo server for PythonUdpPingClient.py. Every datagram is sent back unchanged, straight from one
+# preallocated buffer, with no per packet printing; only aggregated statistics are reported.
+
+MAX_DATAGRAM_SIZE = 65535
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+parser = argparse.ArgumentParser(description="UDP echo server for latency measurement")
+parser.add_argument('--host', default='')
+parser.add_argument('--port', type=int, default=9009)
+parser.add_argument('--stats-interval', type=float, default=5, help="seconds between statistics, 0 disables them")
+args = parser.parse_args()
+
+serverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+serverSocket.bind((args.host, args.port))
+if args.stats_interval:
+    serverSocket.settimeout(args.stats_interval)
+
+buff = bytearray(MAX_DATAGRAM_SIZE)
+view = memoryview(buff)
+
+print(f'PYTHON UDP PING SERVER on port {args.port}')
+
+packets = 0
+received_bytes = 0
+last_packets = 0
+last_report = time.monotonic()
+
+try:
+    while True:
+        try:
+            size, address = serverSocket.recvfrom_into(buff)
+            serverSocket.sendto(view[:size], address)
+            packets += 1
+            received_bytes += size
+        except socket.timeout:
+            pass
+
+        if args.stats_interval:
+            now = time.monotonic()
+            if now - last_report >= args.stats_interval:
+                rate = (packets - last_packets) / (now - last_report)
+                print(f"echoed {packets} packets ({received_bytes} bytes), {rate:.1f} packets/s")
+                last_packets = packets
+                last_report = now
+except KeyboardInterrupt:
+    print(f"echoed {packets} packets ({received_bytes} bytes)")
+finally:
+    serverSocket.close()
@@ -2,11 +2,16 @@ import select
 import socket
 from threading import Thread
 
-from utils import encode_message, receive_message, Logger
+from multicast import MulticastChannel, RELAY_JOIN, RELAY_LEAVE, RELAY_HEADER
+from reliable_udp import ReliableUdp
+from utils import Connection, encode_message, receive_message, Logger, MAX_DATAGRAM_SIZE, JOIN_ROOM, LEAVE_ROOM, \
+    ROOM_MESSAGE, DIRECT_MESSAGE
 
 
 class Client:
-    def __init__(self, server_port: int, server_host: str, nickname: str, multicast_port: int, multicast_group: str):
+    def __init__(self, server_port: int, server_host: str, nickname: str, multicast_port: int, multicast_group: str,
+                 multicast_interface: str = '0.0.0.0', multicast_ttl: int = 1, multicast_loopback: bool = True,
+                 multicast_relay_group: str = None, multicast_relay_port: int = None, compression: str = None):
         self._server_port = server_port
         self._server_host = server_host
         self._nickname = nickname
@@ -15,75 +20,133 @@ class Client:
 
         self._tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         self._tcp_socket.connect((self._server_host, self._server_port))
-        self._tcp_socket.send(encode_message(nickname))
-        self.id = int(self._tcp_socket.recv(8).decode('utf-8'))
+        # the server answers with the compression it accepted, None if it does not support the requested one
+        self._tcp_socket.sendall(encode_message((nickname, compression)))
+        self.id, self._compression = receive_message(self._tcp_socket)
+        self._connection = Connection(self._tcp_socket, self._compression)
 
         _, self._client_port = self._tcp_socket.getsockname()
 
         self._udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self._udp_socket.bind(('', self._client_port))
+        self._server_address = (socket.gethostbyname(self._server_host), self._server_port)
+        self._reliable_udp = ReliableUdp(self._udp_socket)
 
-        self._udp_multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self._udp_multicast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._udp_multicast_socket.bind((self._multicast_group, self._multicast_port))
+        self._multicast = MulticastChannel(
+            self._multicast_group, self._multicast_port, multicast_interface, multicast_ttl, multicast_loopback
+        )
+
+        # subscribes to the server's multicast relay, the server then stops sending plain UDP messages to us one by one
+        self._multicast_relay = None
+        if multicast_relay_group:
+            self._multicast_relay = MulticastChannel(multicast_relay_group, multicast_relay_port, multicast_interface)
+            self._reliable_udp.send(RELAY_JOIN, self._server_address)
 
         Thread(target=self.listen, args=(), daemon=True).start()
 
     def send_tcp(self, message: str):
-        encoded_message = encode_message(message)
-        self._tcp_socket.sendall(encoded_message)
+        self._connection.send(message)
+
+    def join_room(self, room: str):
+        self._connection.send((JOIN_ROOM, room))
+
+    def leave_room(self, room: str):
+        self._connection.send((LEAVE_ROOM, room))
+
+    def send_room(self, room: str, message: str):
+        self._connection.send((ROOM_MESSAGE, room, message))
+
+    def send_direct(self, client_id: int, message: str):
+        self._connection.send((DIRECT_MESSAGE, client_id, message))
 
     def send_udp(self, message: str):
         self._udp_socket.sendto(message.encode('utf-8'), (self._server_host, self._server_port))
 
-    def send_multicast_udp(self, message: str):
-        self._udp_multicast_socket.sendto(f"{self._nickname}#{self.id}>{message}".encode('utf-8'), (self._multicast_group, self._multicast_port))
+    def send_reliable_udp(self, message: str):
+        self._reliable_udp.send(message.encode('utf-8'), self._server_address)
+
+    def send_multicast_udp(self, message: str, group: str = None):
+        self._multicast.send(f"{self._nickname}#{self.id}>{message}".encode('utf-8'), group)
+
+    def join_multicast_group(self, group: str):
+        self._multicast.join(group)
+
+    def leave_multicast_group(self, group: str):
+        self._multicast.leave(group)
 
     def close(self):
-        self._udp_multicast_socket.close()
+        if self._multicast_relay is not None:
+            self._reliable_udp.send(RELAY_LEAVE, self._server_address)
+            self._multicast_relay.close()
+        self._reliable_udp.close()
+        self._multicast.close()
         self._tcp_socket.close()
         self._udp_socket.close()
 
     def listen(self):
         while True:
-            selected_sockets, _, _ = select.select([self._tcp_socket, self._udp_socket, self._udp_multicast_socket], [],
-                                                   [])
+            sockets = [self._tcp_socket, self._udp_socket, self._multicast]
+            if self._multicast_relay is not None:
+                sockets.append(self._multicast_relay)
+            selected_sockets, _, _ = select.select(sockets, [], [])
 
             if self._tcp_socket in selected_sockets:
-                message = receive_message(self._tcp_socket)
+                messages = self._connection.receive_messages()
 
-                if not message:
+                if not messages:
                     Logger.error("Server disconnected")
                     exit(1)
 
-                print(f'[TCP] {message}')
+                for message in messages:
+                    print(f'[TCP] {message}')
 
             if self._udp_socket in selected_sockets:
-                message, _ = self._udp_socket.recvfrom(1024)
-                message = message.decode('utf-8')
-                print(f'[UDP] {message}')
-
-            if self._udp_multicast_socket in selected_sockets:
-                message, _ = self._udp_multicast_socket.recvfrom(1024)
+                datagram, address = self._udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+                reliable_messages = self._reliable_udp.receive(datagram, address)
+                if reliable_messages is None:
+                    print(f'[UDP] {datagram.decode("utf-8")}')
+                else:
+                    for message in reliable_messages:
+                        print(f'[RUDP] {message.decode("utf-8")}')
+
+            if self._multicast in selected_sockets:
+                message, _ = self._multicast.socket.recvfrom(MAX_DATAGRAM_SIZE)
                 message = message.decode('utf-8')
                 print(f'[MULTICAST] {message}')
 
+            if self._multicast_relay is not None and self._multicast_relay in selected_sockets:
+                datagram, _ = self._multicast_relay.socket.recvfrom(MAX_DATAGRAM_SIZE)
+                if len(datagram) >= RELAY_HEADER.size and RELAY_HEADER.unpack_from(datagram)[0] != self.id:
+                    print(f'[UDP] {datagram[RELAY_HEADER.size:].decode("utf-8")}')
+
 
 if __name__ == '__main__':
     SERVER_PORT = 8000
     SERVER_HOST = 'localhost'
     MULTICAST_PORT = 8001
     MULTICAST_GROUP = "224.0.0.1"
+    MULTICAST_RELAY_PORT = 8002
+    MULTICAST_RELAY_GROUP = "239.0.0.1"
+    COMPRESSION = 'zlib'
 
     nickname = None
     while not nickname:
         nickname = input("Your name: ")
 
-    client = Client(SERVER_PORT, SERVER_HOST, nickname, MULTICAST_PORT, MULTICAST_GROUP)
+    client = Client(SERVER_PORT, SERVER_HOST, nickname, MULTICAST_PORT, MULTICAST_GROUP,
+                    multicast_relay_group=MULTICAST_RELAY_GROUP, multicast_relay_port=MULTICAST_RELAY_PORT,
+                    compression=COMPRESSION)
 
     TCP = 't'
     UDP = 'u'
+    RELIABLE_UDP = 'r'
     MULTICAST = 'm'
+    MULTICAST_JOIN = 'mjoin'
+    MULTICAST_LEAVE = 'mleave'
+    JOIN = 'join'
+    LEAVE = 'leave'
+    ROOM = 'to'
+    DIRECT = 'dm'
     while True:
         try:
             line = input()
@@ -105,7 +168,34 @@ if __name__ == '__main__':
             client.send_tcp(message)
         elif command == UDP:
             client.send_udp(message)
+        elif command == RELIABLE_UDP:
+            client.send_reliable_udp(message)
         elif command == MULTICAST:
             client.send_multicast_udp(message)
+        elif command in (MULTICAST_JOIN, MULTICAST_LEAVE):
+            try:
+                if command == MULTICAST_JOIN:
+                    client.join_multicast_group(message.strip())
+                else:
+                    client.leave_multicast_group(message.strip())
+            except OSError:
+                print(f'Invalid multicast group {message.strip()}')
+        elif command in (JOIN, LEAVE):
+            if not message.strip():
+                print(f'Usage: /{command} <room>')
+            elif command == JOIN:
+                client.join_room(message.strip())
+            else:
+                client.leave_room(message.strip())
+        elif command in (ROOM, DIRECT):
+            target, *rest = message.split(' ', 1)
+            if not target or not rest:
+                print(f'Usage: /{command} <{"room" if command == ROOM else "client id"}> <message>')
+            elif command == ROOM:
+                client.send_room(target, rest[0])
+            elif not target.isdigit():
+                print(f'Invalid client id {target}')
+            else:
+                client.send_direct(int(target), rest[0])
         else:
             print(f'Invalid command /{command}')
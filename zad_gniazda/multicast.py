@@ -0,0 +1,83 @@
+import socket
+import struct
+import sys
+from typing import Set
+
+# sent by clients to the server over reliable UDP to subscribe to or unsubscribe from the server's multicast relay,
+# 0xFE never starts a utf-8 chat message
+RELAY_JOIN = b'\xfeRELAY_JOIN'
+RELAY_LEAVE = b'\xfeRELAY_LEAVE'
+# relayed datagrams are prefixed with the sender's client id, so the sender can skip its own messages
+RELAY_HEADER = struct.Struct('>I')
+
+# Linux only, not exported by the socket module
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+
+class MulticastChannel:
+    """
+    UDP socket sending to and, when receive is set, listening on a multicast group.
+    The interface is the local IPv4 address used for membership and outgoing datagrams, 0.0.0.0 lets the OS pick.
+    """
+
+    def __init__(self, group: str, port: int, interface: str = '0.0.0.0', ttl: int = 1, loopback: bool = True,
+                 receive: bool = True):
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.joined_groups: Set[str] = set()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.set_ttl(ttl)
+        self.set_loopback(loopback)
+
+        if receive:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # bound to any address rather than to the group, so datagrams of every joined group are received
+            self.socket.bind(('', port))
+            if sys.platform.startswith('linux'):
+                # otherwise Linux delivers groups joined by any socket of the host to every socket bound to the port
+                self.socket.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+            self.join(group)
+
+    def _membership(self, group: str) -> bytes:
+        return struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(self.interface))
+
+    def join(self, group: str):
+        if group in self.joined_groups:
+            return
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self._membership(group))
+        self.joined_groups.add(group)
+
+    def leave(self, group: str):
+        if group not in self.joined_groups:
+            return
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, self._membership(group))
+        self.joined_groups.discard(group)
+
+    def set_ttl(self, ttl: int):
+        # 1 keeps datagrams on the local network
+        if not 0 <= ttl <= 255:
+            raise ValueError(f"Multicast TTL should be in 0-255, got {ttl}")
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('B', ttl))
+
+    def set_loopback(self, loopback: bool):
+        # whether datagrams sent from this host are delivered to its own members as well
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, struct.pack('B', int(loopback)))
+
+    def send(self, data: bytes, group: str = None):
+        self.socket.sendto(data, (group or self.group, self.port))
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        for group in list(self.joined_groups):
+            try:
+                self.leave(group)
+            except OSError:
+                pass
+        self.socket.close()
@@ -0,0 +1,233 @@
+import random
+import struct
+import time
+from collections import deque
+from threading import Thread, Lock
+from typing import Dict, List, Optional, Tuple
+
+from utils import Logger
+
+# Optional reliability layer over a plain UDP socket: sequence numbers, cumulative + selective acks,
+# retransmission timers and fragmentation of payloads larger than one datagram.
+# Reliable datagrams start with MAGIC, which is never the first byte of a utf-8 message,
+# so they can share a socket with plain UDP messages.
+
+MAGIC = 0xFF
+DATA = 1
+ACK = 2
+
+# magic, type, session, sequence number, fragment index, fragments amount
+DATA_HEADER = struct.Struct('>BBIIHH')
+# magic, type, session, next expected sequence number, bitmap of received packets after it
+ACK_HEADER = struct.Struct('>BBIII')
+
+MAX_FRAGMENT_SIZE = 1200
+MAX_FRAGMENTS = 0xFFFF
+WINDOW_SIZE = 256
+SACK_BITS = 32
+
+INITIAL_RTO = 0.2
+MIN_RTO = 0.05
+MAX_RTO = 1.0
+MAX_RETRANSMISSIONS = 15
+TIMER_INTERVAL = 0.01
+
+SEQUENCE_MODULO = 2 ** 32
+# replaced sessions of a peer remembered, so their delayed datagrams cannot bring them back
+REPLACED_SESSIONS = 16
+
+
+def unwrap_sequence(wire_sequence: int, reference: int) -> int:
+    # sequence numbers are sent modulo 2^32, pick the full value closest to the reference
+    difference = (wire_sequence - reference) % SEQUENCE_MODULO
+    if difference >= SEQUENCE_MODULO // 2:
+        difference -= SEQUENCE_MODULO
+    return reference + difference
+
+
+class _Peer:
+    def __init__(self):
+        self.reset_sending()
+
+        # receiving side
+        self.remote_session: Optional[int] = None
+        self.replaced_sessions = deque(maxlen=REPLACED_SESSIONS)
+        self.expected_sequence = 0
+        self.out_of_order: Dict[int, Tuple[int, int, bytes]] = {}
+        self.fragments: List[bytes] = []
+
+    def reset_sending(self):
+        # a new session tells the receiver to drop its state and start again from sequence 0
+        self.session = random.getrandbits(32)
+        self.next_sequence = 0
+        self.unacked: Dict[int, list] = {}
+        self.pending = deque()
+        self.srtt: Optional[float] = None
+        self.rttvar: float = 0
+        self.rto: float = INITIAL_RTO
+
+    def update_rto(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+
+class ReliableUdp:
+    def __init__(self, udp_socket):
+        self._socket = udp_socket
+        self._peers: Dict[tuple, _Peer] = {}
+        self._lock = Lock()
+
+        self.run_thread = True
+        Thread(target=self._retransmit, args=(), daemon=True).start()
+
+    @staticmethod
+    def is_reliable(datagram: bytes) -> bool:
+        return len(datagram) >= 2 and datagram[0] == MAGIC
+
+    def _peer(self, address) -> _Peer:
+        if address not in self._peers:
+            self._peers[address] = _Peer()
+        return self._peers[address]
+
+    def forget(self, address):
+        with self._lock:
+            self._peers.pop(address, None)
+
+    def close(self):
+        self.run_thread = False
+
+    def send(self, data: bytes, address):
+        fragments = [data[start:start + MAX_FRAGMENT_SIZE] for start in range(0, len(data), MAX_FRAGMENT_SIZE)] or [b'']
+        if len(fragments) > MAX_FRAGMENTS:
+            raise ValueError(f"Message of {len(data)} bytes is too long")
+
+        with self._lock:
+            peer = self._peer(address)
+            for index, fragment in enumerate(fragments):
+                packet = DATA_HEADER.pack(
+                    MAGIC, DATA, peer.session, peer.next_sequence % SEQUENCE_MODULO, index, len(fragments)
+                ) + fragment
+                peer.pending.append((peer.next_sequence, packet))
+                peer.next_sequence += 1
+            self._flush(peer, address)
+
+    def _flush(self, peer: _Peer, address):
+        while peer.pending and len(peer.unacked) < WINDOW_SIZE:
+            sequence, packet = peer.pending.popleft()
+            peer.unacked[sequence] = [packet, time.monotonic(), 0]
+            self._socket.sendto(packet, address)
+
+    def receive(self, datagram: bytes, address) -> Optional[List[bytes]]:
+        """
+        Handles a datagram received from address. Returns None for plain UDP datagrams,
+        otherwise the list of messages completed by it, in the order they were sent.
+        """
+        if not ReliableUdp.is_reliable(datagram):
+            return None
+
+        with self._lock:
+            if datagram[1] == ACK and len(datagram) >= ACK_HEADER.size:
+                self._handle_ack(datagram, address)
+                return []
+
+            if datagram[1] == DATA and len(datagram) >= DATA_HEADER.size:
+                return self._handle_data(datagram, address)
+
+        return []
+
+    def _handle_data(self, datagram: bytes, address) -> List[bytes]:
+        _, _, session, wire_sequence, index, fragments_amount = DATA_HEADER.unpack_from(datagram)
+        peer = self._peer(address)
+
+        if peer.remote_session != session:
+            if session in peer.replaced_sessions:
+                # sent before the peer started its current session and delayed in the network
+                return []
+            if peer.remote_session is not None:
+                peer.replaced_sessions.append(peer.remote_session)
+            peer.remote_session = session
+            peer.expected_sequence = 0
+            peer.out_of_order = {}
+            peer.fragments = []
+
+        sequence = unwrap_sequence(wire_sequence, peer.expected_sequence)
+        if peer.expected_sequence <= sequence < peer.expected_sequence + WINDOW_SIZE:
+            peer.out_of_order.setdefault(sequence, (index, fragments_amount, datagram[DATA_HEADER.size:]))
+
+        messages = []
+        while peer.expected_sequence in peer.out_of_order:
+            index, fragments_amount, payload = peer.out_of_order.pop(peer.expected_sequence)
+            peer.expected_sequence += 1
+
+            if index == 0:
+                peer.fragments = []
+            peer.fragments.append(payload)
+            if index == fragments_amount - 1:
+                messages.append(b''.join(peer.fragments))
+                peer.fragments = []
+
+        # duplicates are acked as well, the previous ack might have been lost
+        selective_acks = 0
+        for bit in range(SACK_BITS):
+            if peer.expected_sequence + 1 + bit in peer.out_of_order:
+                selective_acks |= 1 << bit
+        self._socket.sendto(
+            ACK_HEADER.pack(MAGIC, ACK, session, peer.expected_sequence % SEQUENCE_MODULO, selective_acks), address
+        )
+
+        return messages
+
+    def _handle_ack(self, datagram: bytes, address):
+        _, _, session, wire_sequence, selective_acks = ACK_HEADER.unpack_from(datagram)
+        peer = self._peers.get(address)
+        if peer is None or peer.session != session or not peer.unacked:
+            return
+
+        acked_until = unwrap_sequence(wire_sequence, min(peer.unacked))
+        now = time.monotonic()
+        for sequence in list(peer.unacked):
+            offset = sequence - acked_until - 1
+            if sequence < acked_until or (0 <= offset < SACK_BITS and selective_acks & (1 << offset)):
+                _, sent_at, retransmissions = peer.unacked.pop(sequence)
+                if not retransmissions:
+                    # Karn's algorithm, only packets sent once give unambiguous rtt samples
+                    peer.update_rto(now - sent_at)
+
+        # packets acked after a gap mean the first missing one was most likely lost, resend it without waiting for its timer
+        missing = peer.unacked.get(acked_until)
+        if selective_acks and missing is not None and now - missing[1] >= (peer.srtt or INITIAL_RTO):
+            missing[1] = now
+            missing[2] += 1
+            self._socket.sendto(missing[0], address)
+
+        self._flush(peer, address)
+
+    def _retransmit(self):
+        while self.run_thread:
+            time.sleep(TIMER_INTERVAL)
+
+            with self._lock:
+                now = time.monotonic()
+                for address, peer in list(self._peers.items()):
+                    for sequence, entry in list(peer.unacked.items()):
+                        packet, sent_at, retransmissions = entry
+                        if now - sent_at < min(peer.rto * 2 ** retransmissions, MAX_RTO):
+                            continue
+
+                        if retransmissions >= MAX_RETRANSMISSIONS:
+                            # the peer is unreachable, start a new session instead of stalling the stream forever
+                            Logger.error(f"Reliable UDP: {address} did not ack packet {sequence}, dropping unsent data")
+                            peer.reset_sending()
+                            break
+
+                        entry[1] = now
+                        entry[2] += 1
+                        try:
+                            self._socket.sendto(packet, address)
+                        except OSError:
+                            pass
@@ -1,14 +1,31 @@
 import socket
-from threading import Thread
-from utils import Logger, receive_message, encode_message
+from threading import Thread, Lock, Event
+from multicast import MulticastChannel, RELAY_JOIN, RELAY_LEAVE, RELAY_HEADER
+from reliable_udp import ReliableUdp
+from utils import Logger, Connection, receive_message, encode_message, MAX_DATAGRAM_SIZE, JOIN_ROOM, LEAVE_ROOM, \
+    ROOM_MESSAGE, DIRECT_MESSAGE, COMPRESSIONS
 
 
 class Server:
+    FLUSH_EVENT = 6
+    CONNECTION = 5
+    ROOMS = 4
+    MULTICAST_RELAY = 3
     USERNAME = 2
     SOCKET = 1
     ADDRESS = 0
 
-    def __init__(self, server_port: int, server_host: str = 'localhost'):
+    # argument types of every TCP command
+    COMMAND_ARGUMENTS = {
+        JOIN_ROOM: (str,),
+        LEAVE_ROOM: (str,),
+        ROOM_MESSAGE: (str, str),
+        DIRECT_MESSAGE: (int, str)
+    }
+
+    def __init__(self, server_port: int, server_host: str = 'localhost', multicast_relay_group: str = None,
+                 multicast_relay_port: int = None, multicast_interface: str = '0.0.0.0', multicast_ttl: int = 1,
+                 coalesce_window_us: int = 0):
         self.tcp_thread = None
         self.udp_thread = None
         self._server_port = server_port
@@ -16,6 +33,13 @@ class Server:
 
         self._connected_clients = dict()
 
+        # room name -> ids of its members, so room messages only touch subscribers
+        self._rooms = dict()
+        self._rooms_lock = Lock()
+
+        # TCP frames sent within this window are coalesced into one sendall per client, 0 sends every frame at once
+        self._coalesce_window = coalesce_window_us / 1_000_000
+
         self._tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         self._udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 
@@ -26,6 +50,15 @@ class Server:
             Logger.error("Address already taken")
             exit(1)
 
+        self._reliable_udp = ReliableUdp(self._udp_socket)
+
+        # clients subscribed to the relay group get plain UDP messages from one multicast send instead of unicast
+        self._multicast_relay = None
+        if multicast_relay_group:
+            self._multicast_relay = MulticastChannel(
+                multicast_relay_group, multicast_relay_port, multicast_interface, multicast_ttl, loopback=True, receive=False
+            )
+
         self.run_threads = True
 
         Logger.info("Server initiated successfully")
@@ -43,60 +76,217 @@ class Server:
             self._connected_clients[client_id] = dict()
             self._connected_clients[client_id][Server.SOCKET] = client_socket
             self._connected_clients[client_id][Server.ADDRESS] = client_address
+            self._connected_clients[client_id][Server.ROOMS] = set()
 
             Thread(target=self._handle_tcp_client, args=(client_id,)).start()
 
             Logger.info(f"New client {client_ip}:{client_port} connected successfully with id={client_id}")
 
     def _handle_tcp_client(self, client_id):
-        client_address = self._connected_clients[client_id][Server.ADDRESS]
         client_socket = self._connected_clients[client_id][Server.SOCKET]
 
-        nickname = receive_message(client_socket)
+        # new clients send (nickname, compression) and get (id, accepted compression) back in a frame,
+        # old ones send only the nickname and get the raw id
+        handshake = receive_message(client_socket)
+        if isinstance(handshake, tuple):
+            nickname, compression = handshake
+            compression = compression if compression in COMPRESSIONS else None
+            client_socket.sendall(encode_message((client_id, compression)))
+        else:
+            nickname, compression = handshake, None
+            client_socket.send(f"{client_id}".encode('utf-8'))
+
+        connection = Connection(client_socket, compression, coalesce=self._coalesce_window > 0)
         self._connected_clients[client_id][Server.USERNAME] = nickname
-
-        client_socket.send(f"{client_id}".encode('utf-8'))
+        if connection.coalesce:
+            self._connected_clients[client_id][Server.FLUSH_EVENT] = Event()
+        self._connected_clients[client_id][Server.CONNECTION] = connection
+        if connection.coalesce:
+            # every client has its own flusher, so one slow client blocking in sendall delays only its own messages
+            Thread(
+                target=self._flush_connection,
+                args=(client_id, connection, self._connected_clients[client_id][Server.FLUSH_EVENT]),
+                daemon=True
+            ).start()
 
         while self.run_threads:
-            client_message = receive_message(client_socket)
+            client_messages = connection.receive_messages()
 
-            if not client_message:
+            if not client_messages:
                 self.remove_client(client_id)
                 break
 
-            message = f"{nickname}#{client_id}> {client_message}"
+            for client_message in client_messages:
+                if isinstance(client_message, tuple):
+                    self._handle_tcp_command(client_id, nickname, client_message)
+                    continue
+
+                message = f"{nickname}#{client_id}> {client_message}"
+                Logger.info(f"TCP: {message}")
+
+                encoded_message = encode_message(message)
+                for other_client_id in list(self._connected_clients.keys()):
+                    if other_client_id != client_id:
+                        self._send_to(other_client_id, encoded_message=encoded_message)
+
+    @staticmethod
+    def _is_valid_command(command) -> bool:
+        if not command or command[0] not in Server.COMMAND_ARGUMENTS:
+            return False
+        argument_types = Server.COMMAND_ARGUMENTS[command[0]]
+        return len(command) == len(argument_types) + 1 and all(
+            isinstance(argument, argument_type) for argument, argument_type in zip(command[1:], argument_types)
+        )
+
+    def _handle_tcp_command(self, client_id, nickname, command):
+        # malformed commands would otherwise kill the client's handler thread without removing the client
+        if not Server._is_valid_command(command):
+            self._send_to(client_id, f"Invalid command {command[0] if command else command}")
+            return
+
+        name, *arguments = command
+
+        if name == JOIN_ROOM and len(arguments) == 1:
+            room, = arguments
+            with self._rooms_lock:
+                self._rooms.setdefault(room, set()).add(client_id)
+                self._connected_clients[client_id][Server.ROOMS].add(room)
+            Logger.info(f"Client with id={client_id} joined room {room}")
+            self._send_to(client_id, f"Joined room {room}")
+
+        elif name == LEAVE_ROOM and len(arguments) == 1:
+            room, = arguments
+            self._leave_room(client_id, room)
+            Logger.info(f"Client with id={client_id} left room {room}")
+            self._send_to(client_id, f"Left room {room}")
+
+        elif name == ROOM_MESSAGE and len(arguments) == 2:
+            room, client_message = arguments
+            with self._rooms_lock:
+                members = set(self._rooms.get(room, ()))
+            if client_id not in members:
+                self._send_to(client_id, f"Join room {room} before sending messages to it")
+                return
+
+            message = f"[{room}] {nickname}#{client_id}> {client_message}"
             Logger.info(f"TCP: {message}")
-
             encoded_message = encode_message(message)
-            for client_info in self._connected_clients.values():
-                socket = client_info[Server.SOCKET]
-                if socket != client_socket:
-                    socket.sendall(encoded_message)
+            for member_id in members:
+                if member_id != client_id:
+                    self._send_to(member_id, encoded_message=encoded_message)
+
+        elif name == DIRECT_MESSAGE and len(arguments) == 2:
+            receiver_id, client_message = arguments
+            if receiver_id not in self._connected_clients:
+                self._send_to(client_id, f"Client with id={receiver_id} not found")
+                return
+
+            message = f"(direct) {nickname}#{client_id}> {client_message}"
+            Logger.info(f"TCP to id={receiver_id}: {message}")
+            self._send_to(receiver_id, message)
+
+        else:
+            self._send_to(client_id, f"Invalid command {name}")
+
+    def _send_to(self, client_id, message: str = None, encoded_message: bytes = None):
+        client_info = self._connected_clients.get(client_id)
+        connection = client_info.get(Server.CONNECTION) if client_info is not None else None
+        if connection is None:
+            return
+
+        try:
+            needs_flush = connection.send_frame(encoded_message or encode_message(message))
+        except OSError:
+            return
+
+        if needs_flush:
+            client_info[Server.FLUSH_EVENT].set()
+
+    def _flush_connection(self, client_id, connection: Connection, flush_event: Event):
+        while self.run_threads and self._connected_clients.get(client_id, {}).get(Server.CONNECTION) is connection:
+            flush_event.wait()
+            flush_event.clear()
+            # frames arriving within the window are sent together, unless COALESCE_MAX_BYTES are waiting earlier
+            connection.full.wait(self._coalesce_window)
+
+            try:
+                connection.flush()
+            except OSError:
+                return
+
+    def _leave_room(self, client_id, room):
+        with self._rooms_lock:
+            members = self._rooms.get(room)
+            if members is not None:
+                members.discard(client_id)
+                if not members:
+                    del self._rooms[room]
+            if client_id in self._connected_clients:
+                self._connected_clients[client_id][Server.ROOMS].discard(room)
 
     def _receive_udp(self):
         while self.run_threads:
-            client_message, client_address = self._udp_socket.recvfrom(1024)
-            client_message = client_message.decode('utf-8')
-
-            client_id = None
-            nickname = None
-            for id, client_info in self._connected_clients.items():
-                if client_info[Server.ADDRESS] == client_address:
-                    client_id = id
-                    nickname = client_info[Server.USERNAME]
-
-            message = f"{nickname}#{client_id}> {client_message}"
-            Logger.info(f"UDP: {message}")
-
-            message = message.encode('utf-8')
-            for client_info in self._connected_clients.values():
-                if client_info[Server.ADDRESS] != client_address:
+            datagram, client_address = self._udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+
+            # reliable messages are relayed reliably, plain ones as plain datagrams
+            reliable_messages = self._reliable_udp.receive(datagram, client_address)
+            if reliable_messages is None:
+                self._relay_udp(datagram, client_address, reliable=False)
+            else:
+                for client_message in reliable_messages:
+                    if client_message in (RELAY_JOIN, RELAY_LEAVE):
+                        self._set_multicast_relay(client_address, client_message == RELAY_JOIN)
+                    else:
+                        self._relay_udp(client_message, client_address, reliable=True)
+
+    def _set_multicast_relay(self, client_address, subscribed: bool):
+        if self._multicast_relay is None:
+            return
+
+        for client_id, client_info in list(self._connected_clients.items()):
+            if client_info[Server.ADDRESS] == client_address:
+                client_info[Server.MULTICAST_RELAY] = subscribed
+                Logger.info(f"Client with id={client_id} {'joined' if subscribed else 'left'} the multicast relay")
+
+    def _relay_udp(self, client_message: bytes, client_address, reliable: bool):
+        client_message = client_message.decode('utf-8')
+
+        client_id = None
+        nickname = None
+        for id, client_info in self._connected_clients.items():
+            if client_info[Server.ADDRESS] == client_address:
+                client_id = id
+                nickname = client_info[Server.USERNAME]
+
+        message = f"{nickname}#{client_id}> {client_message}"
+        Logger.info(f"{'Reliable UDP' if reliable else 'UDP'}: {message}")
+
+        message = message.encode('utf-8')
+
+        relayed = False
+        if not reliable and self._multicast_relay is not None and any(
+                client_info.get(Server.MULTICAST_RELAY) for client_info in list(self._connected_clients.values())):
+            self._multicast_relay.send(RELAY_HEADER.pack(client_id or 0) + message)
+            relayed = True
+
+        for client_info in list(self._connected_clients.values()):
+            if client_info[Server.ADDRESS] != client_address:
+                if reliable:
+                    self._reliable_udp.send(message, client_info[Server.ADDRESS])
+                elif not (relayed and client_info.get(Server.MULTICAST_RELAY)):
                     self._udp_socket.sendto(message, client_info[Server.ADDRESS])
 
     def remove_client(self, client_id):
         if client_id in self._connected_clients:
+            for room in list(self._connected_clients[client_id][Server.ROOMS]):
+                self._leave_room(client_id, room)
             self._connected_clients[client_id][Server.SOCKET].close()
+            self._reliable_udp.forget(self._connected_clients[client_id][Server.ADDRESS])
+            flush_event = self._connected_clients[client_id].get(Server.FLUSH_EVENT)
             del self._connected_clients[client_id]
+            if flush_event is not None:
+                # wakes the client's flusher, which exits as the client is gone
+                flush_event.set()
             Logger.info(f"Client with id={client_id} removed")
 
     def listen(self):
@@ -113,6 +303,9 @@ class Server:
 
     def stop(self):
         self.run_threads = False
+        self._reliable_udp.close()
+        if self._multicast_relay is not None:
+            self._multicast_relay.close()
 
         self._udp_socket.close()
         self._tcp_socket.close()
@@ -124,7 +317,11 @@ class Server:
 
 if __name__ == '__main__':
     SERVER_PORT = 8000
-    server = Server(SERVER_PORT)
+    MULTICAST_RELAY_PORT = 8002
+    MULTICAST_RELAY_GROUP = "239.0.0.1"
+    COALESCE_WINDOW_US = 500
+    server = Server(SERVER_PORT, multicast_relay_group=MULTICAST_RELAY_GROUP, multicast_relay_port=MULTICAST_RELAY_PORT,
+                    coalesce_window_us=COALESCE_WINDOW_US)
     try:
         server.listen()
     finally:
@@ -1,5 +1,16 @@
 import pickle
 import struct
+import socket
+import zlib
+from threading import Lock, Event
+
+MAX_DATAGRAM_SIZE = 65535
+
+# TCP commands, sent as tuples (command, *arguments) instead of plain strings, which are broadcast to everyone
+JOIN_ROOM = 'join'
+LEAVE_ROOM = 'leave'
+ROOM_MESSAGE = 'room'
+DIRECT_MESSAGE = 'dm'
 
 
 class Logger:
@@ -34,3 +45,108 @@ def receive_message(connection):
         data = b''
 
     return data
+
+
+COMPRESSIONS = ('zlib',)
+# coalesced frames are sent right away once this many bytes are waiting
+COALESCE_MAX_BYTES = 64 * 1024
+# a client this far behind is disconnected instead of having frames buffered without bound
+COALESCE_MAX_PENDING_BYTES = 4 * 1024 * 1024
+
+
+def receive_exactly(connection, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise OSError("Connection closed")
+        data += chunk
+    return data
+
+
+class Connection:
+    """
+    Framed TCP connection. With compression negotiated, the stream of encode_message frames is compressed with one
+    zlib context per direction, and sent as length prefixed compressed blocks flushed with Z_SYNC_FLUSH.
+    With coalescing, frames are only buffered and sent together by flush(), reducing sendall calls for small messages,
+    so threads sending frames never block on a slow peer. full is set once COALESCE_MAX_BYTES are waiting, and a peer
+    falling COALESCE_MAX_PENDING_BYTES behind is disconnected.
+    """
+
+    def __init__(self, connection, compression: str = None, coalesce: bool = False):
+        self.socket = connection
+        self.compression = compression
+        self.coalesce = coalesce
+
+        # _send_lock keeps compressed blocks in order on the socket, _pending_lock only guards the buffer
+        self._send_lock = Lock()
+        self._pending_lock = Lock()
+        self._pending = []
+        self._pending_size = 0
+        self._overflowed = False
+        self.full = Event()
+        self._compressor = zlib.compressobj() if compression == 'zlib' else None
+        self._decompressor = zlib.decompressobj() if compression == 'zlib' else None
+        self._received = b""
+
+    def send(self, data):
+        self.send_frame(encode_message(data))
+
+    def send_frame(self, frame: bytes) -> bool:
+        """Sends a frame from encode_message, returns True if it was buffered and needs a flush()."""
+        with self._pending_lock:
+            if self._overflowed:
+                return False
+            if self.coalesce and self._pending_size + len(frame) > COALESCE_MAX_PENDING_BYTES:
+                self._overflowed = True
+                Logger.error(f"Disconnecting slow client, {self._pending_size} bytes already pending")
+                # wakes the receiving thread of the client, which removes it
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return False
+            self._pending.append(frame)
+            self._pending_size += len(frame)
+            if self.coalesce:
+                if self._pending_size >= COALESCE_MAX_BYTES:
+                    self.full.set()
+                return True
+        self.flush()
+        return False
+
+    def flush(self):
+        with self._send_lock:
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                data = b"".join(self._pending)
+                self._pending = []
+                self._pending_size = 0
+                self.full.clear()
+
+            if self._compressor is not None:
+                compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+                data = struct.pack('>I', len(compressed)) + compressed
+            self.socket.sendall(data)
+
+    def receive_messages(self) -> list:
+        """Blocks for the next frame, or compressed block, and returns the messages in it, empty once disconnected."""
+        if self._decompressor is None:
+            message = receive_message(self.socket)
+            return [message] if message else []
+
+        try:
+            compressed_size = struct.unpack('>I', receive_exactly(self.socket, 4))[0]
+            self._received += self._decompressor.decompress(receive_exactly(self.socket, compressed_size))
+        except (OSError, struct.error, zlib.error):
+            return []
+
+        messages = []
+        while len(self._received) >= 4:
+            data_size = struct.unpack_from('>I', self._received)[0]
+            if len(self._received) < 4 + data_size:
+                break
+            messages.append(pickle.loads(self._received[4:4 + data_size]))
+            self._received = self._received[4 + data_size:]
+        return messages
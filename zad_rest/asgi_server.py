@@ -0,0 +1,315 @@
+import asyncio
+import json
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import List, Dict, Tuple, Iterable, AsyncIterator
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+from weather import WeatherResponse, MeteoSourceService, M3OService, CityWeatherReport, CityNotFoundException, \
+    WeatherNotFetchedException, RateLimitExceededException, RESPONSE_PARSE_ERRORS, TTLCache, aggregate_weather_responses, normalize_city_name, parse_days, \
+    city_id_cache, forecast_cache, rate_limiters, MAX_BATCH_CITIES
+from refresh import refresh_scheduler
+
+templates = Jinja2Templates(directory=os.path.dirname(os.path.abspath(__file__)))
+
+MAX_UPSTREAM_CONNECTIONS = 500
+MAX_UPSTREAM_KEEPALIVE_CONNECTIONS = 100
+# bounded so a stalled provider fails its calls instead of holding every pooled connection forever
+UPSTREAM_TIMEOUT = httpx.Timeout(10, connect=5, pool=5)
+
+
+class AsyncWeatherService(ABC):
+    @abstractmethod
+    async def get_city_id(self, city_name: str):
+        ...
+
+    @abstractmethod
+    async def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
+        ...
+
+
+class AsyncMeteoSourceService(AsyncWeatherService):
+
+    NAME = MeteoSourceService.NAME
+
+    def __init__(self, client: httpx.AsyncClient):
+        self._client = client
+
+    async def get_city_id(self, city_name: str):
+        await asyncio.sleep(MeteoSourceService.LIMITER.reserve())
+        response = await self._client.get(
+            f"{MeteoSourceService.API_URL}/find_places",
+            params=MeteoSourceService.city_id_params(city_name)
+        )
+        return MeteoSourceService.parse_city_id(response)
+
+    async def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
+        await asyncio.sleep(MeteoSourceService.LIMITER.reserve())
+        response = await self._client.get(
+            f"{MeteoSourceService.API_URL}/point",
+            params=MeteoSourceService.weather_forecast_params(city_id)
+        )
+        return MeteoSourceService.parse_weather_forecast(response, days)
+
+
+class AsyncM3OService(AsyncWeatherService):
+
+    NAME = M3OService.NAME
+
+    def __init__(self, client: httpx.AsyncClient):
+        self._client = client
+
+    async def get_city_id(self, city_name: str):
+        return city_name
+
+    async def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
+        await asyncio.sleep(M3OService.LIMITER.reserve())
+        response = await self._client.post(
+            f"{M3OService.API_URL}/v1/weather/Forecast",
+            json=M3OService.weather_forecast_body(city_id, days),
+            headers=M3OService.headers()
+        )
+        return M3OService.parse_weather_forecast(response)
+
+
+class AsyncWeatherFetcher:
+    """
+    Asyncio counterpart of server.WeatherFetcher. Identical upstream calls are shared between cities
+    as a single task awaited by every city that needs it, backed by the same caches from weather.py
+    and the same background refresh of stale forecasts.
+    """
+
+    def __init__(self, weather_services: List[AsyncWeatherService]):
+        self.weather_services: List[AsyncWeatherService] = weather_services
+
+        self._city_id_calls: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._forecast_calls: Dict[Tuple[str, str, int], asyncio.Task] = {}
+
+    def close(self):
+        for task in [*self._city_id_calls.values(), *self._forecast_calls.values()]:
+            task.cancel()
+
+    @staticmethod
+    async def _call_and_cache(cache: TTLCache, key, function, *args, on_stale=None):
+        value, fresh = cache.lookup(key)
+        if value is not None and not fresh:
+            if on_stale is None:
+                value = None
+            else:
+                on_stale()
+        if value is None:
+            value = await function(*args)
+            cache.put(key, value)
+        return value
+
+    @staticmethod
+    def _call_once(calls: Dict, cache: TTLCache, key, function, *args, on_stale=None) -> asyncio.Task:
+        if key not in calls:
+            calls[key] = asyncio.ensure_future(AsyncWeatherFetcher._call_and_cache(cache, key, function, *args, on_stale=on_stale))
+        return calls[key]
+
+    def get_city_id(self, service: AsyncWeatherService, city: str) -> asyncio.Task:
+        return self._call_once(self._city_id_calls, city_id_cache, (service.NAME, normalize_city_name(city)), service.get_city_id, city)
+
+    def fetch_weather_forecast(self, service: AsyncWeatherService, city_id, days: int) -> asyncio.Task:
+        refresh_scheduler.record(service.NAME, city_id, days)
+        return self._call_once(
+            self._forecast_calls, forecast_cache, (service.NAME, str(city_id), days), service.fetch_weather_forecast, city_id, days,
+            on_stale=lambda: refresh_scheduler.request_refresh(service.NAME, city_id, days)
+        )
+
+    async def _collect_from_service(self, service: AsyncWeatherService, city: str, days: int) -> List[WeatherResponse]:
+        city_id = await self.get_city_id(service, city)
+        return await self.fetch_weather_forecast(service, city_id, days)
+
+    async def collect(self, city: str, days: int) -> CityWeatherReport:
+        all_weather_responses = defaultdict(lambda: [])
+        city_fetch_errors = 0
+        weather_fetch_errors = 0
+        rate_limited_errors = 0
+
+        results = await asyncio.gather(
+            *(self._collect_from_service(service, city, days) for service in self.weather_services),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, CityNotFoundException):
+                city_fetch_errors += 1
+            elif isinstance(result, WeatherNotFetchedException):
+                weather_fetch_errors += 1
+            elif isinstance(result, RateLimitExceededException):
+                rate_limited_errors += 1
+            elif isinstance(result, (httpx.HTTPError, *RESPONSE_PARSE_ERRORS)):
+                # an unreachable or misbehaving provider must not fail the whole report
+                print(f"AsyncWeatherFetcher:collect failed for {city}: {result!r}")
+                weather_fetch_errors += 1
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                for response in result:
+                    all_weather_responses[f"{response.year}-{response.month}-{response.day}"].append(response)
+
+        return CityWeatherReport(
+            city,
+            days,
+            len(self.weather_services),
+            city_fetch_errors,
+            weather_fetch_errors,
+            rate_limited_errors,
+            aggregate_weather_responses(all_weather_responses)
+        )
+
+    async def collect_many(self, cities: Iterable[str], days: int) -> AsyncIterator[CityWeatherReport]:
+        unique_cities = {}
+        for city in cities:
+            unique_cities.setdefault(normalize_city_name(city), city)
+
+        city_tasks = [asyncio.ensure_future(self.collect(city, days)) for city in unique_cities.values()]
+        try:
+            for city_task in asyncio.as_completed(city_tasks):
+                yield await city_task
+        finally:
+            for city_task in city_tasks:
+                city_task.cancel()
+
+
+def create_weather_services(request: Request) -> List[AsyncWeatherService]:
+    client = request.app.state.http_client
+    return [AsyncMeteoSourceService(client), AsyncM3OService(client)]
+
+
+async def form_home_page(request: Request):
+    return templates.TemplateResponse('form.html', {'request': request})
+
+
+async def submit_form(request: Request):
+
+    city = request.query_params.get('city')
+    if not city:
+        return templates.TemplateResponse('form.html', {'request': request, 'error': 'City not found'})
+
+    days = int(request.query_params.get('days', 3))
+    if not 1 <= days <= 5:
+        return templates.TemplateResponse('form.html', {'request': request, 'error': 'Days amount in wrong range. Should be in 1-5'})
+
+    fetcher = AsyncWeatherFetcher(create_weather_services(request))
+    try:
+        report = await fetcher.collect(city, days)
+    finally:
+        fetcher.close()
+
+    return templates.TemplateResponse(
+        'weather.html',
+        {
+            'request': request,
+            'city': report.city,
+            'days': report.days,
+            'services_amount': report.services_amount,
+            'city_fetch_errors': report.city_fetch_errors,
+            'weather_fetch_errors': report.weather_fetch_errors,
+            'rate_limited_errors': report.rate_limited_errors,
+            'weather_forecasts': report.weather_forecasts
+        }
+    )
+
+
+async def api_weather(request: Request):
+    city = request.query_params.get('city')
+    if not city:
+        return JSONResponse({"error": "City not found"}, status_code=400)
+
+    days = parse_days(request.query_params.get('days', 3))
+    if days is None:
+        return JSONResponse({"error": "Days amount in wrong range. Should be in 1-5"}, status_code=400)
+
+    fetcher = AsyncWeatherFetcher(create_weather_services(request))
+    try:
+        report = await fetcher.collect(city, days)
+    finally:
+        fetcher.close()
+
+    return JSONResponse(report.serialize())
+
+
+async def api_limits(request: Request):
+    return JSONResponse(list(map(lambda limiter: limiter.serialize(), rate_limiters())))
+
+
+async def api_weather_batch(request: Request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+
+    cities = body.get("cities")
+    if not isinstance(cities, list) or not cities or not all(isinstance(city, str) and city.strip() for city in cities):
+        return JSONResponse({"error": "Cities should be a non-empty list of city names"}, status_code=400)
+    if len(cities) > MAX_BATCH_CITIES:
+        return JSONResponse({"error": f"Too many cities. At most {MAX_BATCH_CITIES} allowed per batch"}, status_code=400)
+
+    days = parse_days(body.get("days", 3))
+    if days is None:
+        return JSONResponse({"error": "Days amount in wrong range. Should be in 1-5"}, status_code=400)
+
+    fetcher = AsyncWeatherFetcher(create_weather_services(request))
+
+    # results are streamed as newline delimited json, one line per city, in order of completion
+    async def generate():
+        try:
+            async for report in fetcher.collect_many(cities, days):
+                yield json.dumps(report.serialize()) + "\n"
+        finally:
+            fetcher.close()
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+
+async def open_http_client():
+    # one pooled client for the whole process, so in-flight forecasts reuse upstream connections
+    app.state.http_client = httpx.AsyncClient(
+        timeout=UPSTREAM_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=MAX_UPSTREAM_CONNECTIONS,
+            max_keepalive_connections=MAX_UPSTREAM_KEEPALIVE_CONNECTIONS
+        )
+    )
+
+
+async def close_http_client():
+    await app.state.http_client.aclose()
+
+
+async def start_refresh_scheduler():
+    # the scheduler refreshes from its own thread with the synchronous services, sharing forecast_cache
+    refresh_scheduler.start()
+
+
+async def stop_refresh_scheduler():
+    refresh_scheduler.stop()
+
+
+app = Starlette(
+    routes=[
+        Route('/', form_home_page, methods=['GET']),
+        Route('/weather', submit_form, methods=['GET']),
+        Route('/api/weather', api_weather, methods=['GET']),
+        Route('/api/weather/batch', api_weather_batch, methods=['POST']),
+        Route('/api/limits', api_limits, methods=['GET']),
+    ],
+    on_startup=[open_http_client, start_refresh_scheduler],
+    on_shutdown=[close_http_client, stop_refresh_scheduler]
+)
+
+
+if __name__ == '__main__':
+    uvicorn.run("asgi_server:app", host="localhost", port=8000)
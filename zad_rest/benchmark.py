@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import List
+
+import httpx
+
+
+# Drives /api/weather of the aggregator, backed by provider_stub.py, at increasing concurrency levels
+# and reports throughput and latency percentiles with the forecast caches enabled and disabled.
+# Responses are counted as degraded when any provider failed to answer, even though the request itself succeeded.
+# Example:
+#   python benchmark.py --server asgi --concurrency 1,10,50,200 --requests 1000 --latency 100
+
+BASE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class LevelResult:
+    def __init__(self, cache: str, concurrency: int, latencies: List[float], errors: int, degraded: int, duration: float):
+        self.cache: str = cache
+        self.concurrency: int = concurrency
+        self.latencies: List[float] = sorted(latencies)
+        self.errors: int = errors
+        self.degraded: int = degraded
+        self.duration: float = duration
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0
+        index = max(math.ceil(percent / 100 * len(self.latencies)) - 1, 0)
+        return self.latencies[index] * 1000
+
+    def __str__(self):
+        requests_amount = len(self.latencies) + self.errors
+        throughput = requests_amount / self.duration if self.duration else 0
+        return f"{self.cache:>5} {self.concurrency:>11} {requests_amount:>8} {self.errors:>6} {self.degraded:>8} {throughput:>10.1f} " \
+               f"{self.percentile(50):>8.1f} {self.percentile(90):>8.1f} {self.percentile(99):>8.1f} {self.percentile(100):>8.1f}"
+
+
+def wait_until_ready(url: str, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {timeout} seconds")
+
+
+@contextmanager
+def run_process(command: List[str], ready_url: str, env=None):
+    process = subprocess.Popen(command, cwd=BASE_DIRECTORY, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(ready_url)
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def aggregator_command(server: str, port: int) -> List[str]:
+    if server == 'flask':
+        return [sys.executable, '-m', 'flask', '--app', 'server', 'run', '--port', str(port)]
+    return [sys.executable, '-m', 'uvicorn', 'asgi_server:app', '--port', str(port), '--log-level', 'warning']
+
+
+async def run_level(url: str, cities: List[str], days: int, concurrency: int, requests_amount: int, cache: str) -> LevelResult:
+    latencies = []
+    errors = 0
+    degraded = 0
+    remaining = requests_amount
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal remaining, errors, degraded
+        while remaining > 0:
+            remaining -= 1
+            started_at = time.perf_counter()
+            try:
+                response = await client.get(f"{url}/api/weather", params={'city': random.choice(cities), 'days': days})
+                if response.status_code != 200:
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started_at)
+
+            report = response.json()
+            if report["city_fetch_errors"] + report["weather_fetch_errors"] + report["rate_limited_errors"] > 0:
+                degraded += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        duration = time.perf_counter() - started_at
+
+    return LevelResult(cache, concurrency, latencies, errors, degraded, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the weather aggregator against local provider stubs")
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='asgi')
+    parser.add_argument('--concurrency', default='1,10,50,100', help="comma separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=500, help="requests sent per concurrency level")
+    parser.add_argument('--cities', type=int, default=50, help="amount of distinct cities requested")
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--cache', choices=['on', 'off', 'both'], default='both')
+    parser.add_argument('--latency', type=float, default=100, help="stub latency in milliseconds")
+    parser.add_argument('--jitter', type=float, default=20, help="stub latency jitter in milliseconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of stub requests failing")
+    parser.add_argument('--provider-rate-limit', type=float, default=0,
+                        help="aggregator rate limit per provider in calls per second, 0 disables it")
+    parser.add_argument('--stub-port', type=int, default=9000)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+    cities = [f"City {index}" for index in range(args.cities)]
+    cache_modes = ['on', 'off'] if args.cache == 'both' else [args.cache]
+
+    stub_url = f"http://localhost:{args.stub_port}"
+    stub_command = [
+        sys.executable, 'provider_stub.py', '--port', str(args.stub_port),
+        '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate)
+    ]
+
+    print(f"server={args.server} stub latency={args.latency}ms jitter={args.jitter}ms error rate={args.error_rate} "
+          f"cities={args.cities} days={args.days}")
+    print(f"{'cache':>5} {'concurrency':>11} {'requests':>8} {'errors':>6} {'degraded':>8} {'req/s':>10} "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+
+    with run_process(stub_command, stub_url):
+        for cache in cache_modes:
+            env = dict(os.environ)
+            env['METEO_SOURCE_API_URL'] = f"{stub_url}/meteosource"
+            env['M3O_API_URL'] = f"{stub_url}/m3o"
+            env['METEO_SOURCE_RATE_LIMIT'] = str(args.provider_rate_limit)
+            env['M3O_RATE_LIMIT'] = str(args.provider_rate_limit)
+            if cache == 'off':
+                env['CITY_ID_CACHE_TTL'] = '0'
+                env['FORECAST_CACHE_TTL'] = '0'
+
+            url = f"http://localhost:{args.port}"
+            with run_process(aggregator_command(args.server, args.port), url, env):
+                for concurrency in concurrency_levels:
+                    result = asyncio.run(run_level(url, cities, args.days, concurrency, args.requests, cache))
+                    print(result, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import datetime
+import random
+import zlib
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route, Mount
+
+
+# Offline stand-in for the MeteoSource and M3O APIs, used to benchmark and test the aggregator without API keys.
+# Point the aggregator at it with:
+#   METEO_SOURCE_API_URL=http://localhost:9000/meteosource M3O_API_URL=http://localhost:9000/m3o
+
+class StubConfig:
+    def __init__(self, latency: float, jitter: float, error_rate: float, forecast_days: int):
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.forecast_days: int = forecast_days
+
+
+config = StubConfig(latency=0.1, jitter=0.02, error_rate=0.0, forecast_days=7)
+
+
+async def simulate_upstream():
+    delay = config.latency + random.uniform(-config.jitter, config.jitter)
+    await asyncio.sleep(max(delay, 0))
+
+    if random.random() < config.error_rate:
+        return JSONResponse({"detail": "Simulated upstream failure"}, status_code=random.choice([429, 500, 503]))
+
+    return None
+
+
+def stub_temperatures(city_id: str, day_offset: int):
+    # deterministic per city and day, so repeated requests are comparable
+    seed = zlib.crc32(f"{city_id.lower()}:{day_offset}".encode('utf-8'))
+    temperature = (seed % 300) / 10 - 5
+    spread = (seed >> 8) % 80 / 10
+    return round(temperature - spread, 1), round(temperature + spread, 1), round(temperature, 1)
+
+
+def forecast_dates(days: int):
+    today = datetime.date.today()
+    return [(today + datetime.timedelta(days=offset)).isoformat() for offset in range(days)]
+
+
+async def meteo_source_find_places(request: Request):
+    error_response = await simulate_upstream()
+    if error_response:
+        return error_response
+
+    text = request.query_params.get('text', '').strip()
+    if not text:
+        return JSONResponse([])
+
+    return JSONResponse([{"name": text, "place_id": text.lower().replace(' ', '-'), "type": "settlement"}])
+
+
+async def meteo_source_point(request: Request):
+    error_response = await simulate_upstream()
+    if error_response:
+        return error_response
+
+    place_id = request.query_params.get('place_id', '')
+
+    data = []
+    for offset, date in enumerate(forecast_dates(config.forecast_days)):
+        min_temperature, max_temperature, temperature = stub_temperatures(place_id, offset)
+        data.append({
+            "day": date,
+            "all_day": {
+                "temperature": temperature,
+                "temperature_min": min_temperature,
+                "temperature_max": max_temperature
+            }
+        })
+
+    return JSONResponse({"daily": {"data": data}})
+
+
+async def m3o_forecast(request: Request):
+    error_response = await simulate_upstream()
+    if error_response:
+        return error_response
+
+    body = await request.json()
+    location = str(body.get('location', ''))
+    days = int(body.get('days', 1))
+
+    forecast = []
+    for offset, date in enumerate(forecast_dates(days)):
+        min_temperature, max_temperature, temperature = stub_temperatures(location, offset)
+        forecast.append({
+            "date": date,
+            "min_temp_c": min_temperature,
+            "max_temp_c": max_temperature,
+            "avg_temp_c": temperature
+        })
+
+    return JSONResponse({"location": location, "forecast": forecast})
+
+
+app = Starlette(
+    routes=[
+        Mount('/meteosource', routes=[
+            Route('/find_places', meteo_source_find_places, methods=['GET']),
+            Route('/point', meteo_source_point, methods=['GET']),
+        ]),
+        Mount('/m3o', routes=[
+            Route('/v1/weather/Forecast', m3o_forecast, methods=['POST']),
+        ]),
+    ]
+)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the MeteoSource and M3O weather APIs")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=100, help="mean response latency in milliseconds")
+    parser.add_argument('--jitter', type=float, default=20, help="uniform latency jitter in milliseconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with an error status")
+    args = parser.parse_args()
+
+    config.latency = args.latency / 1000
+    config.jitter = args.jitter / 1000
+    config.error_rate = args.error_rate
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,153 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event
+from typing import List, Dict, Tuple, Set
+
+import requests
+
+from weather import WeatherService, MeteoSourceService, M3OService, WeatherNotFetchedException, \
+    RateLimitExceededException, TTLCache, forecast_cache
+
+# amount of most requested forecasts per provider kept warm in the cache
+REFRESH_HOT_CITIES = int(os.getenv("REFRESH_HOT_CITIES", 50))
+# hot forecasts expiring within this many seconds are refreshed ahead of time
+REFRESH_AHEAD = float(os.getenv("REFRESH_AHEAD", 60))
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", 5))
+# upper bound of background refresh calls per second sent to a single provider
+REFRESH_RATE_LIMIT = float(os.getenv("REFRESH_RATE_LIMIT", 1))
+# fraction of every provider's daily quota background refreshes leave to user requests
+REFRESH_QUOTA_RESERVE = float(os.getenv("REFRESH_QUOTA_RESERVE", 0.2))
+REFRESH_WORKERS = 4
+
+# request counts are multiplied by this factor every interval, so popularity follows recent traffic
+POPULARITY_DECAY = 0.9
+POPULARITY_MIN = 0.05
+
+
+class RefreshScheduler:
+    """
+    Keeps popular forecasts in forecast_cache fresh. Fetchers record every forecast they need and report
+    stale cache hits; a background thread periodically refreshes the reported stale forecasts and the
+    hottest REFRESH_HOT_CITIES forecasts of every provider before they expire, sending at most
+    REFRESH_RATE_LIMIT calls per second to each provider and only while its RateLimiter has spare tokens
+    and more than REFRESH_QUOTA_RESERVE of its daily quota left, so background refreshes never queue
+    in front of user requests nor use up their quota.
+    """
+
+    def __init__(self, weather_services: List[WeatherService], cache: TTLCache):
+        self._weather_services: Dict[str, WeatherService] = {service.NAME: service for service in weather_services}
+        self._cache = cache
+
+        self._lock = Lock()
+        self._popularity: Dict[Tuple[str, str, int], float] = {}
+        self._city_ids: Dict[Tuple[str, str, int], object] = {}
+        self._requested: Set[Tuple[str, str, int]] = set()
+        self._in_flight: Set[Tuple[str, str, int]] = set()
+
+        self._budget: Dict[str, float] = {service_name: 0 for service_name in self._weather_services}
+        self._executor = None
+        self._thread = None
+        self._wakeup = Event()
+        self.run_thread = False
+
+    def record(self, service_name: str, city_id, days: int):
+        key = (service_name, str(city_id), days)
+        with self._lock:
+            self._popularity[key] = self._popularity.get(key, 0) + 1
+            self._city_ids[key] = city_id
+
+    def request_refresh(self, service_name: str, city_id, days: int):
+        key = (service_name, str(city_id), days)
+        with self._lock:
+            self._requested.add(key)
+            self._city_ids[key] = city_id
+
+    def start(self):
+        if self._thread is not None or self._cache.ttl <= 0:
+            return
+
+        self.run_thread = True
+        self._wakeup = Event()
+        self._executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+        self._thread = Thread(target=self._run, args=(), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self.run_thread = False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        while self.run_thread:
+            self._wakeup.wait(REFRESH_INTERVAL)
+            if self.run_thread:
+                self.refresh_due()
+
+    def _due_keys(self) -> List[Tuple[str, str, int]]:
+        with self._lock:
+            self._popularity = {
+                key: count * POPULARITY_DECAY
+                for key, count in self._popularity.items()
+                if count * POPULARITY_DECAY >= POPULARITY_MIN
+            }
+
+            due = [key for key in self._requested if key not in self._in_flight]
+            for service_name in self._weather_services:
+                service_keys = [key for key in self._popularity if key[0] == service_name]
+                service_keys.sort(key=lambda key: self._popularity[key], reverse=True)
+                for key in service_keys[:REFRESH_HOT_CITIES]:
+                    expires_in = self._cache.expires_in(key)
+                    if expires_in is not None and expires_in < REFRESH_AHEAD \
+                            and key not in self._in_flight and key not in self._requested:
+                        due.append(key)
+
+            self._city_ids = {
+                key: city_id
+                for key, city_id in self._city_ids.items()
+                if key in self._popularity or key in self._requested or key in self._in_flight
+            }
+
+        return due
+
+    def refresh_due(self):
+        # unused budget carries over up to one call, so rates below one call per interval still work
+        for service_name in self._budget:
+            self._budget[service_name] = min(
+                self._budget[service_name] + REFRESH_RATE_LIMIT * REFRESH_INTERVAL,
+                max(REFRESH_RATE_LIMIT * REFRESH_INTERVAL, 1)
+            )
+
+        for key in self._due_keys():
+            service_name = key[0]
+            limiter = self._weather_services[service_name].LIMITER
+            if self._budget.get(service_name, 0) < 1 or not limiter.has_capacity(REFRESH_QUOTA_RESERVE):
+                # over this provider's budget, rate limit or quota share, requested refreshes wait for the next interval
+                continue
+            self._budget[service_name] -= 1
+
+            with self._lock:
+                self._requested.discard(key)
+                self._in_flight.add(key)
+                city_id = self._city_ids.get(key, key[1])
+
+            self._executor.submit(self._refresh, key, city_id)
+
+    def _refresh(self, key: Tuple[str, str, int], city_id):
+        service_name, _, days = key
+        try:
+            self._cache.put(key, self._weather_services[service_name].fetch_weather_forecast(city_id, days))
+        except (WeatherNotFetchedException, RateLimitExceededException):
+            pass
+        except requests.RequestException as e:
+            print(f"RefreshScheduler:_refresh failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+
+refresh_scheduler = RefreshScheduler([MeteoSourceService(), M3OService()], forecast_cache)
@@ -1,176 +1,149 @@
-import os
-from abc import ABC, abstractmethod
+import json
 from collections import defaultdict
-from json import JSONDecodeError
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from threading import Lock
+from typing import List, Dict, Iterable, Iterator, Tuple
 
-from flask import Flask, render_template, request
 import requests
+from flask import Flask, render_template, request, jsonify, Response
 
-from dotenv import load_dotenv
-load_dotenv()
-
-app = Flask(__name__, template_folder='')
-
-
-class WeatherResponse:
-    def __init__(self, min_temperature: float, max_temperature: float, temperature: float, year: int, month: int, day: int):
-        self.min_temperature: float = min_temperature
-        self.max_temperature: float = max_temperature
-        self.temperature: float = temperature
-        self.year: int = year
-        self.month: int = month
-        self.day: int = day
-
-    def __str__(self):
-        return f"{{min: {self.min_temperature}, max: {self.max_temperature}, temp: {self.temperature}, date:{self.year}-{self.month}-{self.day}}}"
-
-    def __repr__(self):
-        return self.__str__()
-
-
-class WeatherForecast:
-    def __init__(self,
-                 avg_min_temperature: float,
-                 stderr_min_temperature: float,
-                 avg_max_temperature: float,
-                 stderr_max_temperature: float,
-                 avg_temperature: float,
-                 stderr_temperature: float,
-                 contributed_services_amount: int,
-                 date: str,
-                 ):
-        self.avg_min_temperature: float = avg_min_temperature
-        self.stderr_min_temperature: float = stderr_min_temperature
-        self.avg_max_temperature: float = avg_max_temperature
-        self.stderr_max_temperature: float = stderr_max_temperature
-        self.avg_temperature: float = avg_temperature
-        self.stderr_temperature: float = stderr_temperature
-        self.contributed_services_amount: int = contributed_services_amount
-        self.date: str = date
-
-
-class WeatherService(ABC):
-    @abstractmethod
-    def get_city_id(self, city_name: str):
-        ...
-
-    @abstractmethod
-    def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
-        ...
+from weather import WeatherService, MeteoSourceService, M3OService, CityWeatherReport, CityNotFoundException, \
+    WeatherNotFetchedException, RateLimitExceededException, RESPONSE_PARSE_ERRORS, TTLCache, aggregate_weather_responses, normalize_city_name, parse_days, \
+    city_id_cache, forecast_cache, rate_limiters, MAX_BATCH_CITIES
 
+from refresh import refresh_scheduler
 
-class CityNotFoundException(RuntimeError):
-    pass
-
-
-class WeatherNotFetchedException(RuntimeError):
-    pass
-
-
-class MeteoSourceService(WeatherService):
-
-    API_URL = "https://www.meteosource.com/api/v1/free"
-    API_KEY = os.getenv("METEO_SOURCE_API_KEY")
-    NAME = "MeteoSource"
-
-    def get_city_id(self, city_name: str):
-        response = requests.get(
-            f"{MeteoSourceService.API_URL}/find_places",
-            params={'language': 'en', 'text': city_name, 'key': MeteoSourceService.API_KEY}
+app = Flask(__name__, template_folder='')
+refresh_scheduler.start()
+
+
+class WeatherFetcher:
+    """
+    Resolves forecasts for many cities concurrently. Upstream calls are shared between cities,
+    so the same (service, city) lookup or (service, city_id, days) forecast is requested only once
+    per fetcher, even if several cities resolve to the same place. Successful results are kept
+    in the process wide caches from weather.py and reused by later fetchers. Stale forecasts are
+    served as they are and refreshed in the background by refresh.refresh_scheduler.
+    """
+
+    UPSTREAM_WORKERS = 32
+    CITY_WORKERS = 16
+
+    def __init__(self, weather_services: List[WeatherService]):
+        self.weather_services: List[WeatherService] = weather_services
+
+        self._upstream_executor = ThreadPoolExecutor(max_workers=WeatherFetcher.UPSTREAM_WORKERS)
+        self._city_executor = ThreadPoolExecutor(max_workers=WeatherFetcher.CITY_WORKERS)
+
+        self._calls_lock = Lock()
+        self._city_id_calls: Dict[Tuple[str, str], Future] = {}
+        self._forecast_calls: Dict[Tuple[str, str, int], Future] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._city_executor.shutdown(wait=False, cancel_futures=True)
+        self._upstream_executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _call_and_cache(cache: TTLCache, key, function, *args):
+        value = function(*args)
+        cache.put(key, value)
+        return value
+
+    def _submit_once(self, calls: Dict, cache: TTLCache, key, function, *args, on_stale=None) -> Future:
+        with self._calls_lock:
+            if key not in calls:
+                value, fresh = cache.lookup(key)
+                if value is not None and not fresh:
+                    if on_stale is None:
+                        value = None
+                    else:
+                        on_stale()
+                if value is not None:
+                    calls[key] = Future()
+                    calls[key].set_result(value)
+                else:
+                    calls[key] = self._upstream_executor.submit(WeatherFetcher._call_and_cache, cache, key, function, *args)
+            return calls[key]
+
+    def get_city_id(self, service: WeatherService, city: str) -> Future:
+        return self._submit_once(self._city_id_calls, city_id_cache, (service.NAME, normalize_city_name(city)), service.get_city_id, city)
+
+    def fetch_weather_forecast(self, service: WeatherService, city_id, days: int) -> Future:
+        refresh_scheduler.record(service.NAME, city_id, days)
+        return self._submit_once(
+            self._forecast_calls, forecast_cache, (service.NAME, str(city_id), days), service.fetch_weather_forecast, city_id, days,
+            on_stale=lambda: refresh_scheduler.request_refresh(service.NAME, city_id, days)
         )
-        if response.status_code != 200:
-            print(f"MeteoSourceService:get_city_id received {response.status_code} status code")
-            try:
-                print(response.json())
-            except JSONDecodeError:
-                print(response.content)
-            raise CityNotFoundException()
 
-        cities = response.json()
-        if not cities:
-            raise CityNotFoundException()
+    def collect(self, city: str, days: int) -> CityWeatherReport:
+        all_weather_responses = defaultdict(lambda: [])
+        city_fetch_errors = 0
+        weather_fetch_errors = 0
+        rate_limited_errors = 0
 
-        return cities[0]["place_id"]
+        city_id_futures = {self.get_city_id(service, city): service for service in self.weather_services}
 
-    def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
-        response = requests.get(
-            f"{MeteoSourceService.API_URL}/point",
-            params={'language': 'en', 'place_id': city_id, "sections": 'daily', 'key': MeteoSourceService.API_KEY, 'units': 'metric'}
-        )
-        if response.status_code != 200:
-            print(f"MeteoSourceService:fetch_weather_forecast received {response.status_code} status code")
+        forecast_futures = []
+        for city_id_future in as_completed(city_id_futures):
             try:
-                print(response.json())
-            except JSONDecodeError:
-                print(response.content)
-            raise WeatherNotFetchedException()
-
-        weather = response.json()
-        daily_weather_forecast = weather["daily"]["data"][:days]
-
-        results = []
-        for daily_weather in daily_weather_forecast:
-            date = daily_weather["day"].split("-")
-            year, month, day = int(date[0]), int(date[1]), int(date[2])
-
-            results.append(
-                WeatherResponse(
-                    daily_weather["all_day"]["temperature_min"],
-                    daily_weather["all_day"]["temperature_max"],
-                    daily_weather["all_day"]["temperature"],
-                    year,
-                    month,
-                    day
-                )
-            )
-
-        return results
-
-
-class M3OService(WeatherService):
-
-    API_URL = "https://api.m3o.com"
-    API_KEY = os.getenv("M3O_API_KEY")
-    NAME = "M3O"
-
-    def get_city_id(self, city_name: str):
-        return city_name
-
-    def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
-        response = requests.post(
-            f"{M3OService.API_URL}/v1/weather/Forecast",
-            json={'location': city_id, 'days': days},
-            headers={'Authorization': f'Bearer {M3OService.API_KEY}'}
-        )
-        if response.status_code != 200:
-            print(f"M3OService:fetch_weather_forecast received {response.status_code} status code")
+                city_id = city_id_future.result()
+            except CityNotFoundException:
+                city_fetch_errors += 1
+                continue
+            except RateLimitExceededException:
+                rate_limited_errors += 1
+                continue
+            except (requests.RequestException, *RESPONSE_PARSE_ERRORS) as e:
+                # an unreachable or misbehaving provider must not fail the whole report
+                print(f"WeatherFetcher:get_city_id failed for {city}: {e!r}")
+                weather_fetch_errors += 1
+                continue
+            forecast_futures.append(self.fetch_weather_forecast(city_id_futures[city_id_future], city_id, days))
+
+        for forecast_future in forecast_futures:
             try:
-                print(response.json())
-            except JSONDecodeError:
-                print(response.content)
-            raise WeatherNotFetchedException()
+                weather_responses = forecast_future.result()
+            except WeatherNotFetchedException:
+                weather_fetch_errors += 1
+                continue
+            except RateLimitExceededException:
+                rate_limited_errors += 1
+                continue
+            except (requests.RequestException, *RESPONSE_PARSE_ERRORS) as e:
+                print(f"WeatherFetcher:fetch_weather_forecast failed for {city}: {e!r}")
+                weather_fetch_errors += 1
+                continue
+            for response in weather_responses:
+                all_weather_responses[f"{response.year}-{response.month}-{response.day}"].append(response)
+
+        return CityWeatherReport(
+            city,
+            days,
+            len(self.weather_services),
+            city_fetch_errors,
+            weather_fetch_errors,
+            rate_limited_errors,
+            aggregate_weather_responses(all_weather_responses)
+        )
 
-        weather = response.json()
-        daily_weather_forecast = weather["forecast"]
+    def collect_many(self, cities: Iterable[str], days: int) -> Iterator[CityWeatherReport]:
+        unique_cities = {}
+        for city in cities:
+            unique_cities.setdefault(normalize_city_name(city), city)
 
-        results = []
-        for daily_weather in daily_weather_forecast:
-            date = daily_weather["date"].split("-")
-            year, month, day = int(date[0]), int(date[1]), int(date[2])
+        city_futures = [self._city_executor.submit(self.collect, city, days) for city in unique_cities.values()]
+        for city_future in as_completed(city_futures):
+            yield city_future.result()
 
-            results.append(
-                WeatherResponse(
-                    daily_weather["min_temp_c"],
-                    daily_weather["max_temp_c"],
-                    daily_weather["avg_temp_c"],
-                    year,
-                    month,
-                    day
-                )
-            )
 
-        return results
+def create_weather_services() -> List[WeatherService]:
+    return [MeteoSourceService(), M3OService()]
 
 
 @app.route('/', methods=['GET'])
@@ -189,59 +162,62 @@ def submit_form():
     if not 1 <= days <= 5:
         return render_template('form.html', error='Days amount in wrong range. Should be in 1-5')
 
-    weather_services: List[WeatherService] = [MeteoSourceService(), M3OService()]
-
-    all_weather_responses = defaultdict(lambda: [])
-    city_fetch_errors = 0
-    weather_fetch_errors = 0
-    for service in weather_services:
-        try:
-            city_id = service.get_city_id(city)
-            weather_responses = service.fetch_weather_forecast(city_id, days)
-            for response in weather_responses:
-                all_weather_responses[f"{response.year}-{response.month}-{response.day}"].append(response)
-        except CityNotFoundException:
-            city_fetch_errors += 1
-        except WeatherNotFetchedException:
-            weather_fetch_errors += 1
-
-    weather_forecasts = []
-    for date, response_list in all_weather_responses.items():
-        responses_amount = len(response_list)
-
-        avg_temperature = sum(map(lambda response: response.temperature, response_list))/responses_amount
-        avg_min_temperature = sum(map(lambda response: response.min_temperature, response_list))/responses_amount
-        avg_max_temperature = sum(map(lambda response: response.max_temperature, response_list))/responses_amount
-
-        if responses_amount > 1:
-            stderr_temperature = ((sum(map(lambda response: (response.temperature-avg_temperature)**2, response_list))/(responses_amount-1))**0.5)/(responses_amount**0.5)
-            stderr_min_temperature = ((sum(map(lambda response: (response.min_temperature-avg_min_temperature)**2, response_list))/(responses_amount-1))**0.5)/(responses_amount**0.5)
-            stderr_max_temperature = ((sum(map(lambda response: (response.max_temperature-avg_max_temperature)**2, response_list))/(responses_amount-1))**0.5)/(responses_amount**0.5)
-        else:
-            stderr_temperature = 0
-            stderr_min_temperature = 0
-            stderr_max_temperature = 0
-
-        weather_forecasts.append(
-            WeatherForecast(
-                round(avg_min_temperature, 2),
-                round(stderr_min_temperature, 2),
-                round(avg_max_temperature, 2),
-                round(stderr_max_temperature, 2),
-                round(avg_temperature, 2),
-                round(stderr_temperature, 2),
-                responses_amount,
-                date
-            )
-        )
+    with WeatherFetcher(create_weather_services()) as fetcher:
+        report = fetcher.collect(city, days)
 
     return render_template(
         'weather.html',
-        city=city,
-        days=days,
-        services_amount=len(weather_services),
-        city_fetch_errors=city_fetch_errors,
-        weather_fetch_errors=weather_fetch_errors,
-        weather_forecasts=weather_forecasts
+        city=report.city,
+        days=report.days,
+        services_amount=report.services_amount,
+        city_fetch_errors=report.city_fetch_errors,
+        weather_fetch_errors=report.weather_fetch_errors,
+        rate_limited_errors=report.rate_limited_errors,
+        weather_forecasts=report.weather_forecasts
     )
 
+
+@app.route('/api/weather', methods=['GET'])
+def api_weather():
+    city = request.args.get('city')
+    if not city:
+        return jsonify({"error": "City not found"}), 400
+
+    days = parse_days(request.args.get('days', 3))
+    if days is None:
+        return jsonify({"error": "Days amount in wrong range. Should be in 1-5"}), 400
+
+    with WeatherFetcher(create_weather_services()) as fetcher:
+        report = fetcher.collect(city, days)
+
+    return jsonify(report.serialize())
+
+
+@app.route('/api/limits', methods=['GET'])
+def api_limits():
+    return jsonify(list(map(lambda limiter: limiter.serialize(), rate_limiters())))
+
+
+@app.route('/api/weather/batch', methods=['POST'])
+def api_weather_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+
+    cities = body.get("cities")
+    if not isinstance(cities, list) or not cities or not all(isinstance(city, str) and city.strip() for city in cities):
+        return jsonify({"error": "Cities should be a non-empty list of city names"}), 400
+    if len(cities) > MAX_BATCH_CITIES:
+        return jsonify({"error": f"Too many cities. At most {MAX_BATCH_CITIES} allowed per batch"}), 400
+
+    days = parse_days(body.get("days", 3))
+    if days is None:
+        return jsonify({"error": "Days amount in wrong range. Should be in 1-5"}), 400
+
+    # results are streamed as newline delimited json, one line per city, in order of completion
+    def generate():
+        with WeatherFetcher(create_weather_services()) as fetcher:
+            for report in fetcher.collect_many(cities, days):
+                yield json.dumps(report.serialize()) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
@@ -0,0 +1,474 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from json import JSONDecodeError
+from threading import Lock
+from typing import List, Dict, Optional, Tuple
+
+import requests
+
+from dotenv import load_dotenv
+load_dotenv()
+
+MAX_BATCH_CITIES = 500
+
+# cache lifetimes in seconds, 0 disables the cache
+CITY_ID_CACHE_TTL = float(os.getenv("CITY_ID_CACHE_TTL", 24 * 60 * 60))
+FORECAST_CACHE_TTL = float(os.getenv("FORECAST_CACHE_TTL", 10 * 60))
+# how long an expired forecast may still be served while it is refreshed in the background
+FORECAST_STALE_TTL = float(os.getenv("FORECAST_STALE_TTL", 10 * 60))
+CACHE_MAX_SIZE = 10000
+
+# how long a call may be queued waiting for a provider rate limit token, 0 fails fast
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 2))
+
+
+class WeatherResponse:
+    def __init__(self, min_temperature: float, max_temperature: float, temperature: float, year: int, month: int, day: int):
+        self.min_temperature: float = min_temperature
+        self.max_temperature: float = max_temperature
+        self.temperature: float = temperature
+        self.year: int = year
+        self.month: int = month
+        self.day: int = day
+
+    def __str__(self):
+        return f"{{min: {self.min_temperature}, max: {self.max_temperature}, temp: {self.temperature}, date:{self.year}-{self.month}-{self.day}}}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class WeatherForecast:
+    def __init__(self,
+                 avg_min_temperature: float,
+                 stderr_min_temperature: float,
+                 avg_max_temperature: float,
+                 stderr_max_temperature: float,
+                 avg_temperature: float,
+                 stderr_temperature: float,
+                 contributed_services_amount: int,
+                 date: str,
+                 ):
+        self.avg_min_temperature: float = avg_min_temperature
+        self.stderr_min_temperature: float = stderr_min_temperature
+        self.avg_max_temperature: float = avg_max_temperature
+        self.stderr_max_temperature: float = stderr_max_temperature
+        self.avg_temperature: float = avg_temperature
+        self.stderr_temperature: float = stderr_temperature
+        self.contributed_services_amount: int = contributed_services_amount
+        self.date: str = date
+
+    def serialize(self):
+        return {
+            "date": self.date,
+            "contributed_services_amount": self.contributed_services_amount,
+            "avg_temperature": self.avg_temperature,
+            "stderr_temperature": self.stderr_temperature,
+            "avg_min_temperature": self.avg_min_temperature,
+            "stderr_min_temperature": self.stderr_min_temperature,
+            "avg_max_temperature": self.avg_max_temperature,
+            "stderr_max_temperature": self.stderr_max_temperature
+        }
+
+
+class CityWeatherReport:
+    def __init__(self,
+                 city: str,
+                 days: int,
+                 services_amount: int,
+                 city_fetch_errors: int,
+                 weather_fetch_errors: int,
+                 rate_limited_errors: int,
+                 weather_forecasts: List[WeatherForecast],
+                 ):
+        self.city: str = city
+        self.days: int = days
+        self.services_amount: int = services_amount
+        self.city_fetch_errors: int = city_fetch_errors
+        self.weather_fetch_errors: int = weather_fetch_errors
+        self.rate_limited_errors: int = rate_limited_errors
+        self.weather_forecasts: List[WeatherForecast] = weather_forecasts
+
+    def serialize(self):
+        return {
+            "city": self.city,
+            "days": self.days,
+            "services_amount": self.services_amount,
+            "city_fetch_errors": self.city_fetch_errors,
+            "weather_fetch_errors": self.weather_fetch_errors,
+            "rate_limited_errors": self.rate_limited_errors,
+            "weather_forecasts": list(map(lambda forecast: forecast.serialize(), self.weather_forecasts))
+        }
+
+
+class WeatherService(ABC):
+    @abstractmethod
+    def get_city_id(self, city_name: str):
+        ...
+
+    @abstractmethod
+    def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
+        ...
+
+
+class CityNotFoundException(RuntimeError):
+    pass
+
+
+class WeatherNotFetchedException(RuntimeError):
+    pass
+
+
+class RateLimitExceededException(RuntimeError):
+    pass
+
+
+# raised by response.json() and by indexing a response body of unexpected shape
+RESPONSE_PARSE_ERRORS = (KeyError, IndexError, TypeError, ValueError)
+
+
+class RateLimiter:
+    """
+    Token bucket with daily quota accounting for a single provider. rate calls per second are allowed with
+    bursts of up to burst calls, and at most daily_quota calls per UTC day (0 disables either limit).
+    Callers over the rate are queued by reserving a future token, as long as they would wait at most
+    max_wait seconds, otherwise they fail fast with RateLimitExceededException.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, daily_quota: int, max_wait: float):
+        self.name: str = name
+        self.rate: float = rate
+        self.burst: float = max(burst, 1)
+        self.daily_quota: int = daily_quota
+        self.max_wait: float = max_wait
+
+        self._lock = Lock()
+        self._tokens: float = self.burst
+        self._updated_at: float = time.monotonic()
+        self._day = datetime.now(timezone.utc).date()
+        self._used_today: int = 0
+        self._rejected: int = 0
+        self._queued: int = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated_at) * self.rate, self.burst)
+        self._updated_at = now
+
+        today = datetime.now(timezone.utc).date()
+        if today != self._day:
+            self._day = today
+            self._used_today = 0
+
+    def reserve(self) -> float:
+        """Takes one call from the budget and returns how many seconds the caller has to wait before making it."""
+        with self._lock:
+            self._refill()
+
+            if self.daily_quota and self._used_today >= self.daily_quota:
+                self._rejected += 1
+                raise RateLimitExceededException(f"{self.name} daily quota of {self.daily_quota} calls exhausted")
+
+            if not self.rate:
+                self._used_today += 1
+                return 0
+
+            wait = max(1 - self._tokens, 0) / self.rate
+            if wait > self.max_wait:
+                self._rejected += 1
+                raise RateLimitExceededException(f"{self.name} rate limit of {self.rate} calls per second exceeded")
+
+            self._tokens -= 1
+            self._used_today += 1
+            if wait:
+                self._queued += 1
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    def has_capacity(self, reserve_fraction: float = 0) -> bool:
+        """Whether a call could be made right away while leaving reserve_fraction of the daily quota unused."""
+        with self._lock:
+            self._refill()
+            if self.daily_quota and self._used_today >= self.daily_quota * (1 - reserve_fraction):
+                return False
+            return not self.rate or self._tokens >= 1
+
+    def serialize(self):
+        with self._lock:
+            self._refill()
+            return {
+                "name": self.name,
+                "rate": self.rate,
+                "burst": self.burst,
+                "available_tokens": round(self._tokens, 2) if self.rate else None,
+                "daily_quota": self.daily_quota or None,
+                "used_today": self._used_today,
+                "remaining_today": max(self.daily_quota - self._used_today, 0) if self.daily_quota else None,
+                "queued_calls": self._queued,
+                "rejected_calls": self._rejected
+            }
+
+
+def create_rate_limiter(name: str, env_prefix: str) -> RateLimiter:
+    return RateLimiter(
+        name,
+        rate=float(os.getenv(f"{env_prefix}_RATE_LIMIT", 5)),
+        burst=float(os.getenv(f"{env_prefix}_BURST", 10)),
+        daily_quota=int(os.getenv(f"{env_prefix}_DAILY_QUOTA", 0)),
+        max_wait=RATE_LIMIT_MAX_WAIT
+    )
+
+
+class TTLCache:
+    """
+    Thread safe in-memory cache with a fixed time to live, evicting the least recently stored entries
+    once max_size is reached. Expired entries are kept for another stale_ttl seconds, so they can still be
+    served while a fresh value is fetched. Failed upstream calls are never stored, so None always means a miss.
+    """
+
+    def __init__(self, ttl: float, max_size: int = CACHE_MAX_SIZE, stale_ttl: float = 0):
+        self.ttl: float = ttl
+        self.stale_ttl: float = stale_ttl
+        self.max_size: int = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def lookup(self, key) -> Tuple[object, bool]:
+        """Returns (value, fresh), where value is None on a miss and fresh is False for stale entries."""
+        if self.ttl <= 0:
+            return None, False
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+
+            value, expires_at = entry
+            now = time.monotonic()
+            if expires_at + self.stale_ttl <= now:
+                del self._entries[key]
+                return None, False
+
+            return value, expires_at > now
+
+    def expires_in(self, key) -> Optional[float]:
+        """Seconds until the entry expires, negative for stale entries, None if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry[1] - time.monotonic()
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+city_id_cache = TTLCache(CITY_ID_CACHE_TTL)
+forecast_cache = TTLCache(FORECAST_CACHE_TTL, stale_ttl=FORECAST_STALE_TTL)
+
+
+def print_error_response(source: str, response):
+    print(f"{source} received {response.status_code} status code")
+    try:
+        print(response.json())
+    except JSONDecodeError:
+        print(response.content)
+
+
+class MeteoSourceService(WeatherService):
+
+    API_URL = os.getenv("METEO_SOURCE_API_URL", "https://www.meteosource.com/api/v1/free")
+    API_KEY = os.getenv("METEO_SOURCE_API_KEY")
+    NAME = "MeteoSource"
+    LIMITER = create_rate_limiter(NAME, "METEO_SOURCE")
+
+    def get_city_id(self, city_name: str):
+        MeteoSourceService.LIMITER.acquire()
+        response = requests.get(
+            f"{MeteoSourceService.API_URL}/find_places",
+            params=MeteoSourceService.city_id_params(city_name)
+        )
+        return MeteoSourceService.parse_city_id(response)
+
+    def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
+        MeteoSourceService.LIMITER.acquire()
+        response = requests.get(
+            f"{MeteoSourceService.API_URL}/point",
+            params=MeteoSourceService.weather_forecast_params(city_id)
+        )
+        return MeteoSourceService.parse_weather_forecast(response, days)
+
+    # request building and response parsing are shared with the async implementation in asgi_server.py
+
+    @staticmethod
+    def city_id_params(city_name: str):
+        return {'language': 'en', 'text': city_name, 'key': MeteoSourceService.API_KEY}
+
+    @staticmethod
+    def weather_forecast_params(city_id):
+        return {'language': 'en', 'place_id': city_id, "sections": 'daily', 'key': MeteoSourceService.API_KEY, 'units': 'metric'}
+
+    @staticmethod
+    def parse_city_id(response):
+        if response.status_code != 200:
+            print_error_response("MeteoSourceService:get_city_id", response)
+            raise CityNotFoundException()
+
+        cities = response.json()
+        if not cities:
+            raise CityNotFoundException()
+
+        return cities[0]["place_id"]
+
+    @staticmethod
+    def parse_weather_forecast(response, days: int) -> List[WeatherResponse]:
+        if response.status_code != 200:
+            print_error_response("MeteoSourceService:fetch_weather_forecast", response)
+            raise WeatherNotFetchedException()
+
+        weather = response.json()
+        daily_weather_forecast = weather["daily"]["data"][:days]
+
+        results = []
+        for daily_weather in daily_weather_forecast:
+            date = daily_weather["day"].split("-")
+            year, month, day = int(date[0]), int(date[1]), int(date[2])
+
+            results.append(
+                WeatherResponse(
+                    daily_weather["all_day"]["temperature_min"],
+                    daily_weather["all_day"]["temperature_max"],
+                    daily_weather["all_day"]["temperature"],
+                    year,
+                    month,
+                    day
+                )
+            )
+
+        return results
+
+
+class M3OService(WeatherService):
+
+    API_URL = os.getenv("M3O_API_URL", "https://api.m3o.com")
+    API_KEY = os.getenv("M3O_API_KEY")
+    NAME = "M3O"
+    LIMITER = create_rate_limiter(NAME, "M3O")
+
+    def get_city_id(self, city_name: str):
+        return city_name
+
+    def fetch_weather_forecast(self, city_id, days: int) -> List[WeatherResponse]:
+        M3OService.LIMITER.acquire()
+        response = requests.post(
+            f"{M3OService.API_URL}/v1/weather/Forecast",
+            json=M3OService.weather_forecast_body(city_id, days),
+            headers=M3OService.headers()
+        )
+        return M3OService.parse_weather_forecast(response)
+
+    # request building and response parsing are shared with the async implementation in asgi_server.py
+
+    @staticmethod
+    def headers():
+        return {'Authorization': f'Bearer {M3OService.API_KEY}'}
+
+    @staticmethod
+    def weather_forecast_body(city_id, days: int):
+        return {'location': city_id, 'days': days}
+
+    @staticmethod
+    def parse_weather_forecast(response) -> List[WeatherResponse]:
+        if response.status_code != 200:
+            print_error_response("M3OService:fetch_weather_forecast", response)
+            raise WeatherNotFetchedException()
+
+        weather = response.json()
+        daily_weather_forecast = weather["forecast"]
+
+        results = []
+        for daily_weather in daily_weather_forecast:
+            date = daily_weather["date"].split("-")
+            year, month, day = int(date[0]), int(date[1]), int(date[2])
+
+            results.append(
+                WeatherResponse(
+                    daily_weather["min_temp_c"],
+                    daily_weather["max_temp_c"],
+                    daily_weather["avg_temp_c"],
+                    year,
+                    month,
+                    day
+                )
+            )
+
+        return results
+
+
+def rate_limiters() -> List[RateLimiter]:
+    return [MeteoSourceService.LIMITER, M3OService.LIMITER]
+
+
+def aggregate_weather_responses(all_weather_responses: Dict[str, List[WeatherResponse]]) -> List[WeatherForecast]:
+    weather_forecasts = []
+    for date, response_list in all_weather_responses.items():
+        responses_amount = len(response_list)
+
+        avg_temperature = sum(map(lambda response: response.temperature, response_list))/responses_amount
+        avg_min_temperature = sum(map(lambda response: response.min_temperature, response_list))/responses_amount
+        avg_max_temperature = sum(map(lambda response: response.max_temperature, response_list))/responses_amount
+
+        if responses_amount > 1:
+            stderr_temperature = ((sum(map(lambda response: (response.temperature-avg_temperature)**2, response_list))/(responses_amount-1))**0.5)/(responses_amount**0.5)
+            stderr_min_temperature = ((sum(map(lambda response: (response.min_temperature-avg_min_temperature)**2, response_list))/(responses_amount-1))**0.5)/(responses_amount**0.5)
+            stderr_max_temperature = ((sum(map(lambda response: (response.max_temperature-avg_max_temperature)**2, response_list))/(responses_amount-1))**0.5)/(responses_amount**0.5)
+        else:
+            stderr_temperature = 0
+            stderr_min_temperature = 0
+            stderr_max_temperature = 0
+
+        weather_forecasts.append(
+            WeatherForecast(
+                round(avg_min_temperature, 2),
+                round(stderr_min_temperature, 2),
+                round(avg_max_temperature, 2),
+                round(stderr_max_temperature, 2),
+                round(avg_temperature, 2),
+                round(stderr_temperature, 2),
+                responses_amount,
+                date
+            )
+        )
+
+    return weather_forecasts
+
+
+def normalize_city_name(city: str) -> str:
+    return " ".join(city.split()).lower()
+
+
+def parse_days(days) -> Optional[int]:
+    try:
+        days = int(days)
+    except (TypeError, ValueError):
+        return None
+
+    if not 1 <= days <= 5:
+        return None
+
+    return days
+